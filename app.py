@@ -1,14 +1,24 @@
 import os
+import html
 import uuid
+import logging
+import requests
+import threading
+import time
 from flask import Flask, render_template, request, send_file, flash, redirect, url_for, jsonify
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
 
 from models import db, User, ImageHistory
-from logo_generator import generate_logo
+from logo_generator import generate_logo, fetch_generation, OperationFailed
+from operation_journal import journaled, forget_operations, drop_operation, is_expired, pending_operations
+
+logger = logging.getLogger(__name__)
 
 # Загружаем переменные окружения (включая MY_API_KEY)
 load_dotenv()
@@ -16,8 +26,11 @@ load_dotenv()
 # Настройки путей и часового пояса
 TZ = ZoneInfo("Europe/Minsk")
 API_KEY = os.getenv("MY_API_KEY", "SuperSecret123")
+BOT_TOKEN = os.getenv("BOT_TOKEN")  # для доставки дозабранных API-генераций в Telegram
 generate_limit = int(os.getenv("generate_limit", 5)) # лимит генераций за час, указываем в .env
 user_imgs_site = int(os.getenv("user_imgs_site", 5)) # количество картинок на сайте, указываем в .env
+user_cache_ttl = int(os.getenv("user_cache_ttl", 300)) # сколько секунд кэшировать пользователя в load_user
+history_cache_ttl = int(os.getenv("history_cache_ttl", 60)) # сколько секунд кэшировать историю на главной
 
 
 # Flask c поддержкой instance/
@@ -30,7 +43,8 @@ results_dir = os.path.join(app.instance_path, "results")
 os.makedirs(results_dir, exist_ok=True)
 
 # Настройки базы
-app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{os.path.join(app.instance_path, 'site.db')}"
+app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv(
+    "DATABASE_URL", f"sqlite:///{os.path.join(app.instance_path, 'site.db')}")  # DATABASE_URL — например, для тестов
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 db.init_app(app)
 
@@ -55,10 +69,90 @@ login_manager = LoginManager(app)
 login_manager.login_view = "login"
 login_manager.login_message = "Пожалуйста, войдите в аккаунт, чтобы получить доступ!"
 
+# Кэш пользователей для load_user: {user_id: (User, время истечения)}
+# Внутри одного запроса Flask-Login и так хранит пользователя в g.
+# Кэшированный User отвязан от сессии и общий для потоков: читать только колонки
+# (id, username, password), ленивая связь histories недоступна (DetachedInstanceError) —
+# историю берём запросом ImageHistory по user_id.
+user_cache = {}
+
+# Кэш отрендеренной истории на главной: {user_id: (html, время истечения)}
+# Сбрасывается после commit'а любого изменения ImageHistory в этом процессе, TTL — страховка
+# от записей в обход ORM или из других процессов
+history_cache = {}
+
+def cache_user(user):
+    """Кладёт пользователя в кэш на {user_cache_ttl} секунд, заодно вычищая просроченные записи"""
+    now = time.monotonic()
+    for cached_id, (_, expires) in list(user_cache.items()):
+        if expires <= now:
+            user_cache.pop(cached_id, None)
+    # Отвязываем от сессии: объект переживёт её закрытие и commit'ы других запросов
+    db.session.expunge(user)
+    user_cache[user.id] = (user, now + user_cache_ttl)
+
 @login_manager.user_loader
 def load_user(user_id):
-    """Flask-Login: загрузка пользователя"""
-    return User.query.get(int(user_id))
+    """Flask-Login: загрузка пользователя (с TTL-кэшем)"""
+    user_id = int(user_id)
+    cached = user_cache.get(user_id)
+    if cached:
+        if cached[1] > time.monotonic():
+            return cached[0]
+        user_cache.pop(user_id, None)
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    cache_user(user)
+    return user
+
+def forget_user(user_id):
+    """Сбрасывает кэши пользователя сайта (вызывать после изменений User)"""
+    user_cache.pop(int(user_id), None)
+    history_cache.pop(int(user_id), None)
+
+# Кэш сбрасываем только после commit'а: если сбросить на flush, параллельный GET /
+# успеет закэшировать ещё не изменённую историю до конца транзакции
+@event.listens_for(Session, "after_flush")
+def collect_history_changes(session, flush_context):
+    """SQLAlchemy: запоминает в session.info пользователей, чья ImageHistory изменилась"""
+    user_ids = session.info.setdefault("history_user_ids", set())
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if not isinstance(obj, ImageHistory):
+            continue
+        user_ids.add(obj.user_id)
+        user_ids.update(inspect(obj).attrs.user_id.history.deleted)  # если user_id меняли
+
+@event.listens_for(Session, "after_commit")
+def invalidate_history(session):
+    """SQLAlchemy: после commit'а сбрасывает кэш истории затронутых пользователей"""
+    for user_id in session.info.pop("history_user_ids", ()):
+        if user_id is None:
+            continue
+        try:
+            history_cache.pop(int(user_id), None)
+        except (TypeError, ValueError):
+            pass
+
+@event.listens_for(Session, "after_rollback")
+def discard_history_changes(session):
+    """SQLAlchemy: изменения откатились — сбрасывать нечего"""
+    session.info.pop("history_user_ids", None)
+
+def render_history(user_id):
+    """HTML-блок истории последних {user_imgs_site} логотипов (кэшируется до изменения истории или TTL)"""
+    now = time.monotonic()
+    cached = history_cache.get(user_id)
+    if cached and cached[1] > now:
+        return cached[0]
+    history = ImageHistory.query.filter_by(user_id=user_id).order_by(
+        ImageHistory.timestamp.desc()).limit(user_imgs_site).all()
+    html = render_template("_history.html", history=history)
+    for cached_id, (_, expires) in list(history_cache.items()):
+        if expires <= now:
+            history_cache.pop(cached_id, None)
+    history_cache[user_id] = (html, now + history_cache_ttl)
+    return html
 
 def create_tables():
     """Инициализация базы"""
@@ -66,6 +160,128 @@ def create_tables():
         db.create_all()
         print("Database tables created successfully!")
 
+def save_result(image_data, prompt, source, user_id=None, tg_user_id=None, operation_ids=()):
+    """
+    Сохраняет картинку в results/ и запись в ImageHistory.
+    Операции operation_ids удаляются из журнала в той же транзакции.
+    Для сайта оставляет только {user_imgs_site} последних картинок пользователя.
+    """
+    # Сохраняем UTC для базы, Минск — для имени файла
+    save_time_utc = datetime.now(ZoneInfo("UTC"))
+    timestamp = save_time_utc.astimezone(TZ).strftime("%Y-%m-%d_%H-%M-%S")
+    file_id = uuid.uuid4().hex
+    filename = f"{timestamp}_{file_id}.jpg"
+    path = os.path.join(results_dir, filename)
+    with open(path, "wb") as f:
+        f.write(image_data)
+
+    record = ImageHistory(
+        prompt=prompt,
+        filename=filename,
+        user_id=user_id,
+        tg_user_id=tg_user_id,
+        timestamp=save_time_utc,
+        source=source
+    )
+    db.session.add(record)
+    forget_operations(operation_ids)
+    db.session.commit()
+
+    if source == "site":
+        # Оставляем только {user_imgs_site} последних
+        all_user_imgs = ImageHistory.query.filter_by(user_id=user_id).order_by(
+            ImageHistory.timestamp.desc()).all()
+        for extra in all_user_imgs[user_imgs_site:]:
+            old_path = os.path.join(results_dir, extra.filename)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+            db.session.delete(extra)
+        db.session.commit()
+    return filename
+
+def send_telegram_photo(chat_id, path, caption):
+    """Отправляет картинку в чат Telegram через Bot API (без aiogram — сайт работает синхронно)"""
+    if not BOT_TOKEN:
+        logger.warning(f"BOT_TOKEN не задан — картинка для tg_user_id={chat_id} не отправлена")
+        return
+    with open(path, "rb") as f:
+        response = requests.post(
+            f"https://api.telegram.org/bot{BOT_TOKEN}/sendPhoto",
+            data={"chat_id": chat_id, "caption": caption, "parse_mode": "HTML"},
+            files={"photo": f},
+            timeout=30
+        )
+    if response.status_code != 200:
+        logger.warning(f"Telegram не принял картинку: {response.status_code} {response.text}")
+
+def resume_pending_operations(started_at):
+    """
+    Дозабирает генерации сайта и API, оборванные падением/рестартом процесса.
+    Из журнала операция удаляется только при окончательной ошибке или по возрасту,
+    временные сбои (сеть, polling timeout) оставляют её до следующего старта.
+    """
+    with app.app_context():
+        for operation in pending_operations("site", "api", before=started_at):
+            if is_expired(operation):
+                logger.warning(f"Операция {operation.id} устарела, удаляю из журнала")
+                drop_operation(operation.id)
+                continue
+            logger.info(f"Возобновляю операцию {operation.id} ({operation.source})")
+            # После save_result строка журнала удалена — дальше работаем с копиями полей
+            prompt, tg_user_id = operation.prompt, operation.tg_user_id
+            try:
+                image_data = fetch_generation(operation.id)
+                filename = save_result(image_data, prompt, operation.source,
+                                       user_id=operation.user_id, tg_user_id=tg_user_id,
+                                       operation_ids=[operation.id])
+            except OperationFailed:
+                logger.exception(f"Операция {operation.id} не удалась, удаляю из журнала")
+                drop_operation(operation.id)
+                continue
+            except Exception:
+                db.session.rollback()
+                logger.exception(f"Не удалось возобновить операцию {operation.id}, повторю при следующем старте")
+                continue
+
+            # API-запрос от имени Telegram-пользователя — доставляем картинку и в чат
+            if tg_user_id:
+                try:
+                    send_telegram_photo(
+                        tg_user_id,
+                        os.path.join(results_dir, filename),
+                        f"🖼️ Вот твой логотип по запросу (генерация прервалась перезапуском сервера):\n"
+                        f"<code>{html.escape(prompt)}</code>"
+                    )
+                except Exception:
+                    logger.exception(f"Не удалось отправить картинку tg_user_id={tg_user_id}")
+
+# Дозабор запускается один раз на процесс; операции, начатые уже этим процессом, не трогаем
+resume_lock = threading.Lock()
+resume_started = False
+process_started_at = datetime.utcnow()
+
+def start_resume(reloader=False):
+    """
+    Создаёт таблицы и запускает в фоне дозабор оборванных операций (один раз на процесс).
+    reloader=True — запуск из `python app.py` с debug-reloader'ом: в процессе-наблюдателе
+    (WERKZEUG_RUN_MAIN не задан) ничего не делаем, дозабор идёт в рабочем процессе.
+    При запуске через `flask run` или WSGI-сервер вызывается перед первым запросом.
+    """
+    global resume_started
+    if reloader and os.environ.get("WERKZEUG_RUN_MAIN") != "true":
+        return
+    with resume_lock:
+        if resume_started:
+            return
+        resume_started = True
+    create_tables()
+    threading.Thread(target=resume_pending_operations, args=(process_started_at,), daemon=True).start()
+
+@app.before_request
+def resume_on_first_request():
+    """flask run / WSGI-сервер: дозабор стартует с первым запросом"""
+    start_resume()
+
 # === WEB-часть ===
 
 @app.route("/register", methods=["GET", "POST"])
@@ -98,6 +314,7 @@ def login():
             flash("Неверный логин или пароль")
             return render_template("login.html")
         login_user(user)
+        cache_user(user)  # свежие данные после входа
         return redirect(url_for("index"))
     return render_template("login.html")
 
@@ -105,6 +322,7 @@ def login():
 @login_required
 def logout():
     """Выход"""
+    forget_user(current_user.id)
     logout_user()
     return redirect(url_for("login"))
 
@@ -114,64 +332,33 @@ def index():
     """Главная страница: генерация и история логотипов"""
     user = current_user
 
-    # Лимит: {generate_limit} генераций за час (по UTC)
-    now_utc = datetime.now(ZoneInfo("UTC"))
-    one_hour_ago_utc = now_utc - timedelta(hours=1)
-    recent = ImageHistory.query.filter_by(user_id=user.id).filter(ImageHistory.timestamp > one_hour_ago_utc).count()
-
     if request.method == "POST":
         prompt = request.form.get("prompt", "").strip()
+
+        # Лимит: {generate_limit} генераций за час (по UTC) — считаем только при генерации
+        now_utc = datetime.now(ZoneInfo("UTC"))
+        one_hour_ago_utc = now_utc - timedelta(hours=1)
+        recent = ImageHistory.query.filter_by(user_id=user.id).filter(ImageHistory.timestamp > one_hour_ago_utc).count()
+
         if not prompt:
             flash("Заполните поле с описанием!")
         elif recent >= generate_limit:
             flash(f"❗ Лимит: не более {generate_limit} генераций в час.")
         else:
             try:
-                # Сохраняем UTC для базы, Минск — для имени файла
-                save_time_utc = datetime.now(ZoneInfo("UTC"))
-                filename_time_minsk = save_time_utc.astimezone(TZ)
-                timestamp = filename_time_minsk.strftime("%Y-%m-%d_%H-%M-%S")
-                file_id = uuid.uuid4().hex
-                filename = f"{timestamp}_{file_id}.jpg"
-                path = os.path.join(results_dir, filename)
-
-                image_data = generate_logo(prompt)
-                with open(path, "wb") as f:
-                    f.write(image_data)
-
-                record = ImageHistory(
-                    prompt=prompt,
-                    filename=filename,
-                    user_id=user.id,
-                    timestamp=save_time_utc,
-                    source="site"
-                )
-                db.session.add(record)
-                db.session.commit()
-
-                # Оставляем только {user_imgs_site} последних
-                all_user_imgs = ImageHistory.query.filter_by(user_id=user.id).order_by(
-                    ImageHistory.timestamp.desc()).all()
-                for extra in all_user_imgs[user_imgs_site:]:
-                    old_path = os.path.join(results_dir, extra.filename)
-                    if os.path.exists(old_path):
-                        os.remove(old_path)
-                    db.session.delete(extra)
-                db.session.commit()
+                operation_ids, on_submit = journaled(prompt, "site", user_id=user.id)
+                image_data = generate_logo(prompt, on_submit=on_submit)
+                save_result(image_data, prompt, "site", user_id=user.id, operation_ids=operation_ids)
                 return redirect(url_for("index"))
             except Exception as e:
                 flash(f"Ошибка генерации: {e}")
 
-    # История последних {user_imgs_site} логотипов
-    history = ImageHistory.query.filter_by(user_id=user.id).order_by(
-        ImageHistory.timestamp.desc()).limit(user_imgs_site).all()
-    for item in history:
-        item.display_time = convert_utc_to_minsk(item.timestamp)
-        item.display_time_str = item.display_time.strftime("%d.%m.%Y %H:%M")
+    # История последних {user_imgs_site} логотипов: при обычном просмотре — из кэша, без БД
+    history_html = render_history(user.id)
 
     current_minsk_time = datetime.now(TZ).strftime("%d.%m.%Y %H:%M")
     return render_template("index.html",
-                           history=history,
+                           history_html=history_html,
                            current_time=current_minsk_time,
                            TZ=TZ)
 
@@ -207,31 +394,16 @@ def api_generate():
         return jsonify({"error": "Missing prompt or user/tg_user_id"}), 400
 
     try:
-        image_data = generate_logo(prompt)
-        now_utc = datetime.now(ZoneInfo("UTC"))
-        filename_time = now_utc.astimezone(TZ).strftime("%Y-%m-%d_%H-%M-%S")
-        file_id = uuid.uuid4().hex
-        filename = f"{filename_time}_{file_id}.jpg"
-        path = os.path.join(results_dir, filename)
-        with open(path, "wb") as f:
-            f.write(image_data)
-        with app.app_context():
-            record = ImageHistory(
-                prompt=prompt,
-                filename=filename,
-                user_id=user_id,
-                tg_user_id=tg_user_id,
-                source="api",
-                timestamp=now_utc
-            )
-            db.session.add(record)
-            db.session.commit()
+        operation_ids, on_submit = journaled(prompt, "api", user_id=user_id, tg_user_id=tg_user_id)
+        image_data = generate_logo(prompt, on_submit=on_submit)
+        filename = save_result(image_data, prompt, "api", user_id=user_id, tg_user_id=tg_user_id,
+                               operation_ids=operation_ids)
         return jsonify({"status": "ok", "filename": filename}), 200
     except Exception as e:
         return jsonify({"error": f"Generation failed: {e}"}), 500
 
 if __name__ == "__main__":
-    create_tables()
+    start_resume(reloader=True)
     app.run(debug=True)
 
 
@@ -1,4 +1,5 @@
 import os
+import html
 import datetime
 import asyncio
 import logging
@@ -12,7 +13,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import FSInputFile
 
-from logo_generator import generate_logo
+from logo_generator import generate_logo, fetch_generation, OperationFailed
 
 # --- Инициализация логирования ---
 logging.basicConfig(level=logging.INFO)
@@ -31,6 +32,7 @@ if not BOT_TOKEN or not OPENAI_API_KEY:
 # --- Импортируем Flask-приложение и базу данных ---
 from app import app, db
 from models import ImageHistory
+from operation_journal import journaled, forget_operations, drop_operation, is_expired, pending_operations
 
 # --- Настройки ---
 results_dir = os.path.join(app.instance_path, "results")
@@ -58,6 +60,74 @@ HELP_TEXT = (
     "✍️ Просто напишите текст — я поддержу разговор или подскажу дату/время!"
 )
 
+# --- Сохранение результата генерации ---
+def save_bot_result(image_data, prompt, tg_user_id, operation_ids=()):
+    """
+    Сохраняет картинку и запись в ImageHistory (вызывать внутри app.app_context()).
+    Операции operation_ids удаляются из журнала в той же транзакции.
+    Возвращает: str — путь к файлу
+    """
+    now_utc = datetime.datetime.utcnow()
+    timestamp = now_utc.strftime("%Y-%m-%d_%H-%M-%S")
+    filename = f"tg_{tg_user_id}_{timestamp}.jpg"
+    filepath = os.path.join(results_dir, filename)
+    with open(filepath, "wb") as file:
+        file.write(image_data)
+
+    # --- Сохраняем в БД и удаляем старые записи ---
+    record = ImageHistory(prompt=prompt, filename=filename, tg_user_id=tg_user_id, source="bot", timestamp=now_utc)
+    db.session.add(record)
+    forget_operations(operation_ids)
+    db.session.commit()
+
+    all_imgs = ImageHistory.query.filter_by(tg_user_id=tg_user_id, source="bot") \
+        .order_by(ImageHistory.timestamp.desc()).all()
+    for extra in all_imgs[10:]:
+        old_path = os.path.join(results_dir, extra.filename)
+        if os.path.exists(old_path):
+            os.remove(old_path)
+        db.session.delete(extra)
+    db.session.commit()
+    return filepath
+
+# --- Возобновление генераций, оборванных рестартом бота ---
+async def resume_pending_operations(started_at):
+    # Операции, начатые уже этим процессом (started_at, UTC), опрашивают живые обработчики
+    with app.app_context():
+        operations = pending_operations("bot", before=started_at)
+    for operation in operations:
+        if is_expired(operation):
+            logger.warning(f"Операция {operation.id} устарела, удаляю из журнала")
+            with app.app_context():
+                drop_operation(operation.id)
+            continue
+        logger.info(f"Возобновляю операцию {operation.id} для tg_user_id={operation.tg_user_id}")
+        try:
+            image_data = await asyncio.to_thread(fetch_generation, operation.id)
+            with app.app_context():
+                filepath = save_bot_result(image_data, operation.prompt, operation.tg_user_id,
+                                           operation_ids=[operation.id])
+        except OperationFailed:
+            # Окончательная ошибка — дозабирать нечего
+            logger.exception(f"Операция {operation.id} не удалась, удаляю из журнала")
+            with app.app_context():
+                drop_operation(operation.id)
+            continue
+        except Exception:
+            # Временный сбой — операция остаётся в журнале до следующего старта
+            logger.exception(f"Не удалось возобновить операцию {operation.id}, повторю при следующем старте")
+            continue
+
+        try:
+            await bot.send_photo(
+                operation.tg_user_id,
+                FSInputFile(filepath),
+                caption=f"🖼️ Вот твой логотип по запросу (генерация прервалась перезапуском бота):\n<code>{html.escape(operation.prompt)}</code>",
+                parse_mode=ParseMode.HTML
+            )
+        except Exception:
+            logger.exception(f"Не удалось отправить картинку tg_user_id={operation.tg_user_id}")
+
 # --- Обработчики команд ---
 
 @dp.message(Command("start"))
@@ -99,29 +169,11 @@ async def handle_image_prompt(message: types.Message, state: FSMContext):
 
     await message.answer("⏳ Генерирую изображение...")
     try:
-        image_data = generate_logo(prompt)
-
-        now_utc = datetime.datetime.utcnow()
-        timestamp = now_utc.strftime("%Y-%m-%d_%H-%M-%S")
-        filename = f"tg_{tg_user_id}_{timestamp}.jpg"
-        filepath = os.path.join(results_dir, filename)
-        with open(filepath, "wb") as file:
-            file.write(image_data)
-
-        # --- Сохраняем в БД и удаляем старые записи ---
+        # --- ID операции пишется в журнал до polling: при рестарте бота картинка не потеряется ---
         with app.app_context():
-            record = ImageHistory(prompt=prompt, filename=filename, tg_user_id=tg_user_id, source="bot", timestamp=now_utc)
-            db.session.add(record)
-            db.session.commit()
-
-            all_imgs = ImageHistory.query.filter_by(tg_user_id=tg_user_id, source="bot") \
-                .order_by(ImageHistory.timestamp.desc()).all()
-            for extra in all_imgs[10:]:
-                old_path = os.path.join(results_dir, extra.filename)
-                if os.path.exists(old_path):
-                    os.remove(old_path)
-                db.session.delete(extra)
-            db.session.commit()
+            operation_ids, on_submit = journaled(prompt, "bot", tg_user_id=tg_user_id)
+            image_data = generate_logo(prompt, on_submit=on_submit)
+            filepath = save_bot_result(image_data, prompt, tg_user_id, operation_ids=operation_ids)
 
         await message.answer_photo(FSInputFile(filepath), caption=f"🖼️ Вот твой логотип по запросу:\n<code>{prompt}</code>", parse_mode=ParseMode.HTML)
 
@@ -188,5 +240,16 @@ async def chat_handler(message: types.Message):
         await message.answer(f"⚠️ Ошибка OpenAI: {e}")
 
 # --- Точка входа ---
+async def main():
+    started_at = datetime.datetime.utcnow()
+    with app.app_context():
+        db.create_all()  # таблица журнала могла ещё не существовать
+    # Дозабор оборванных генераций — в фоне, чтобы бот сразу отвечал пользователям
+    resume_task = asyncio.create_task(resume_pending_operations(started_at))
+    try:
+        await dp.start_polling(bot)
+    finally:
+        resume_task.cancel()
+
 if __name__ == "__main__":
-    asyncio.run(dp.start_polling(bot))
+    asyncio.run(main())
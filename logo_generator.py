@@ -17,12 +17,15 @@ CATALOG_ID = os.getenv("CATALOG_ID")
 if not CATALOG_ID:
     raise Exception("❌ Не найден CATALOG_ID в .env! Проверьте конфигурацию.")
 
-def generate_logo(prompt: str) -> bytes:
+class OperationFailed(Exception):
+    """Операция Yandex ART окончательно не удалась (не найдена или завершилась с ошибкой)"""
+
+def submit_generation(prompt: str, iam_token: str = None) -> str:
     """
-    Генерация логотипа через Yandex ART API с устойчивостью к сбоям.
-    Выполняется polling + повторные попытки при временных ошибках.
+    Отправляет задачу генерации в Yandex ART.
+    Возвращает: str — ID асинхронной операции
     """
-    iam_token = get_iam_token()
+    iam_token = iam_token or get_iam_token()
     url = "https://llm.api.cloud.yandex.net/foundationModels/v1/imageGenerationAsync"
     headers = {
         "Authorization": f"Bearer {iam_token}",
@@ -37,46 +40,80 @@ def generate_logo(prompt: str) -> bytes:
         "messages": [{"weight": "1", "text": prompt[:250]}]  # обрезаем до 250 символов
     }
 
+    response = requests.post(url, headers=headers, json=data, timeout=15)
+    if response.status_code != 200:
+        raise Exception(f"Ошибка генерации: {response.status_code} {response.text}")
+
+    request_id = response.json().get("id")
+    if not request_id:
+        raise Exception("Yandex не вернул ID задачи. Ответ: " + response.text)
+
+    logger.info(f"[Yandex ART] Старт генерации. request_id={request_id}")
+    return request_id
+
+def fetch_generation(request_id: str, iam_token: str = None) -> bytes:
+    """
+    Polling: ожидание завершения операции Yandex ART и получение картинки.
+    Работает и для операций, запущенных до рестарта процесса.
+    """
+    iam_token = iam_token or get_iam_token()
+    url_check = f"https://llm.api.cloud.yandex.net/operations/{request_id}"
+    headers_check = {"Authorization": f"Bearer {iam_token}"}
+
+    for poll_attempt in range(10):
+        time.sleep(2)
+        try:
+            response_check = requests.get(url_check, headers=headers_check, timeout=10)
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"[Yandex ART] Ошибка при опросе: {e}")
+            continue
+
+        if response_check.status_code == 404:
+            raise OperationFailed(f"Операция {request_id} не найдена")
+        if response_check.status_code != 200:
+            continue
+
+        operation = response_check.json()
+        if "response" in operation and "image" in operation["response"]:
+            image_base64 = operation["response"]["image"]
+            logger.info("[Yandex ART] Картинка готова. Декодируем...")
+            try:
+                return base64.b64decode(image_base64)
+            except Exception as e:
+                raise OperationFailed("Ошибка декодирования base64: " + str(e))
+        if operation.get("done") and "error" in operation:
+            raise OperationFailed(f"Операция {request_id} завершилась с ошибкой: {operation['error']}")
+
+    raise Exception("Истёк таймер ожидания генерации (polling timeout)")
+
+def generate_logo(prompt: str, on_submit=None) -> bytes:
+    """
+    Генерация логотипа через Yandex ART API с устойчивостью к сбоям.
+    Выполняется polling + повторные попытки при временных ошибках.
+    on_submit(request_id) вызывается сразу после запуска операции, до polling —
+    чтобы вызывающий код успел записать ID в журнал (см. operation_journal.py).
+    """
+    iam_token = get_iam_token()
+    request_id = None
+
     # --- Повторная попытка генерации (макс. 3 раза) ---
     for attempt in range(3):
         try:
-            response = requests.post(url, headers=headers, json=data, timeout=15)
-            if response.status_code != 200:
-                logger.warning(f"[Yandex ART] Ошибка генерации: {response.status_code} {response.text}")
-                time.sleep(1)
-                continue
-
-            request_id = response.json().get("id")
-            if not request_id:
-                raise Exception("Yandex не вернул ID задачи. Ответ: " + response.text)
-
-            logger.info(f"[Yandex ART] Старт генерации. request_id={request_id}")
-            # --- Polling: ожидание завершения генерации ---
-            url_check = f"https://llm.api.cloud.yandex.net/operations/{request_id}"
-            headers_check = {"Authorization": f"Bearer {iam_token}"}
-
-            for poll_attempt in range(10):
-                time.sleep(2)
-                try:
-                    response_check = requests.get(url_check, headers=headers_check, timeout=10)
-                except requests.exceptions.RequestException as e:
-                    logger.warning(f"[Yandex ART] Ошибка при опросе: {e}")
-                    continue
-
-                if (
-                    response_check.status_code == 200 and
-                    "response" in response_check.json() and
-                    "image" in response_check.json()["response"]
-                ):
-                    image_base64 = response_check.json()["response"]["image"]
-                    logger.info("[Yandex ART] Картинка готова. Декодируем...")
+            # Запущенная (оплаченная) операция повторно не запускается — только опрашивается
+            if request_id is None:
+                request_id = submit_generation(prompt, iam_token)
+                if on_submit:
+                    # Сбой журнала не должен приводить к повторной (платной) генерации
                     try:
-                        return base64.b64decode(image_base64)
+                        on_submit(request_id)
                     except Exception as e:
-                        raise Exception("Ошибка декодирования base64: " + str(e))
-
-            raise Exception("Истёк таймер ожидания генерации (polling timeout)")
+                        logger.warning(f"[Yandex ART] Не удалось записать операцию в журнал: {e}")
+            return fetch_generation(request_id, iam_token)
 
+        except OperationFailed as e:
+            logger.warning(f"[Yandex ART] {e}")
+            request_id = None  # операция не удалась окончательно — можно запустить новую
+            time.sleep(2)
         except requests.exceptions.RequestException as e:
             logger.warning(f"[Yandex ART] Ошибка подключения: {e}")
             time.sleep(2)
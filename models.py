@@ -13,7 +13,8 @@ class User(UserMixin, db.Model):
     username = db.Column(db.String(64), unique=True, nullable=False)
     password = db.Column(db.String(128), nullable=False)  # хранит хэш пароля
 
-    # История генераций (только для сайта)
+    # История генераций (только для сайта).
+    # У пользователя из кэша load_user (app.user_cache) недоступна — он отвязан от сессии
     histories = db.relationship('ImageHistory', backref='user', lazy=True)
 
     def __repr__(self):
@@ -46,3 +47,24 @@ class ImageHistory(db.Model):
         return "<ImageHistory(unknown)>"
 
 
+
+class PendingOperation(db.Model):
+    """
+    Журнал незавершённых генераций Yandex ART (общий для сайта и Telegram-бота).
+    Запись создаётся сразу после получения ID операции, до polling, и удаляется
+    вместе с сохранением результата в ImageHistory. Записи, оставшиеся после
+    падения/рестарта процесса, дозабираются при старте сайта или бота.
+    """
+    id = db.Column(db.String(64), primary_key=True)            # ID операции Yandex
+    prompt = db.Column(db.String(256), nullable=False)         # Текст запроса (промпт)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # --- Владелец: как в ImageHistory ---
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    tg_user_id = db.Column(db.BigInteger, nullable=True)
+
+    # Источник генерации ("site", "api" или "bot") — определяет, кто дозабирает операцию
+    source = db.Column(db.String(10), default="site", nullable=False)
+
+    def __repr__(self):
+        return f"<PendingOperation(id='{self.id}', source='{self.source}', prompt='{self.prompt[:10]}...')>"
@@ -0,0 +1,68 @@
+# Журнал незавершённых генераций: ID операции Yandex ART сохраняется в БД до polling,
+# чтобы при рестарте сайта или бота оплаченная картинка не терялась.
+# Все функции работают внутри app.app_context().
+import os
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+
+from models import db, PendingOperation
+
+load_dotenv()
+pending_max_age_hours = int(os.getenv("pending_max_age_hours", 24)) # сколько часов дозабирать операцию, указываем в .env
+
+def journaled(prompt, source, user_id=None, tg_user_id=None):
+    """
+    Журнал одной генерации. Возвращает список ID операций и колбэк для
+    generate_logo(on_submit=...), который пишет каждую операцию в журнал.
+    Записи удаляются только вместе с сохранением картинки (operation_ids в
+    save_result/save_bot_result). Если генерация не завершилась, записи остаются
+    и дозабираются при следующем старте.
+
+        operation_ids, on_submit = journaled(prompt, "site", user_id=user.id)
+        image_data = generate_logo(prompt, on_submit=on_submit)
+    """
+    operation_ids = []
+
+    def on_submit(operation_id):
+        operation_ids.append(operation_id)
+        db.session.add(PendingOperation(
+            id=operation_id,
+            prompt=prompt[:256],
+            user_id=user_id,
+            tg_user_id=tg_user_id,
+            source=source
+        ))
+        try:
+            db.session.commit()
+        except Exception:
+            # Сессия должна остаться рабочей: дальше в ней сохраняется оплаченная картинка
+            db.session.rollback()
+            raise
+
+    return operation_ids, on_submit
+
+def forget_operations(operation_ids):
+    """Удаляет операции из журнала (без commit — чтобы попасть в одну транзакцию с ImageHistory)"""
+    if operation_ids:
+        PendingOperation.query.filter(PendingOperation.id.in_(list(operation_ids))) \
+            .delete(synchronize_session=False)
+
+def drop_operation(operation_id):
+    """Удаляет операцию из журнала окончательно (результат уже не получить)"""
+    db.session.rollback()
+    forget_operations([operation_id])
+    db.session.commit()
+
+def is_expired(operation):
+    """Операция старше {pending_max_age_hours} часов — дозабирать её больше не пытаемся"""
+    return operation.created_at < datetime.utcnow() - timedelta(hours=pending_max_age_hours)
+
+def pending_operations(*sources, before=None):
+    """
+    Незавершённые операции указанных источников, от старых к новым.
+    before (UTC) — отсекает операции, запущенные уже текущим процессом.
+    """
+    query = PendingOperation.query.filter(PendingOperation.source.in_(sources))
+    if before is not None:
+        query = query.filter(PendingOperation.created_at < before)
+    return query.order_by(PendingOperation.created_at).all()
@@ -0,0 +1,99 @@
+import os
+import time
+
+import pytest
+from sqlalchemy import event
+
+os.environ.setdefault("CATALOG_ID", "test_catalog")
+os.environ.setdefault("OAUTH_TOKEN", "test_token")
+os.environ["DATABASE_URL"] = "sqlite:///:memory:"
+
+import app as site
+from models import db, ImageHistory
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(site, "results_dir", str(tmp_path))
+    monkeypatch.setattr(site, "resume_started", True)  # без фонового дозабора
+    site.user_cache.clear()
+    site.history_cache.clear()
+    with site.app.app_context():
+        db.create_all()
+    client = site.app.test_client()
+    client.post("/register", data={"username": "user", "password": "secret"})
+    client.post("/login", data={"username": "user", "password": "secret"})
+    yield client
+    with site.app.app_context():
+        db.drop_all()
+
+@pytest.fixture
+def sql_count():
+    counter = {"queries": 0}
+
+    def count(*args):
+        counter["queries"] += 1
+
+    with site.app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", count)
+    yield counter
+    event.remove(engine, "before_cursor_execute", count)
+
+def test_login_caches_user(client):
+    assert list(site.user_cache) == [1]
+
+def test_second_index_get_runs_no_sql(client, sql_count):
+    assert client.get("/").status_code == 200
+    sql_count["queries"] = 0
+
+    assert client.get("/").status_code == 200
+    assert sql_count["queries"] == 0
+
+def test_save_result_drops_cached_history(client, monkeypatch):
+    monkeypatch.setattr(site, "user_imgs_site", 1)
+    client.get("/")
+    assert 1 in site.history_cache
+
+    with site.app.app_context():
+        site.save_result(b"img", "первый", "site", user_id=1)
+    assert 1 not in site.history_cache
+    assert "первый" in client.get("/").text
+
+    # Вставка второго и удаление первого (лимит user_imgs_site=1)
+    with site.app.app_context():
+        site.save_result(b"img", "второй", "site", user_id=1)
+        assert ImageHistory.query.count() == 1
+    assert 1 not in site.history_cache
+    page = client.get("/").text
+    assert "второй" in page and "первый" not in page
+
+def test_history_cache_is_dropped_only_after_commit(client):
+    client.get("/")
+    with site.app.app_context():
+        db.session.add(ImageHistory(prompt="кот", filename="f.jpg", user_id=1))
+        db.session.flush()
+        assert 1 in site.history_cache
+        db.session.rollback()
+    assert 1 in site.history_cache
+
+    with site.app.app_context():
+        db.session.add(ImageHistory(prompt="кот", filename="f.jpg", user_id=1))
+        db.session.commit()
+    assert 1 not in site.history_cache
+
+def test_expired_user_cache_entry_is_reloaded(client):
+    cached_user, _ = site.user_cache[1]
+    site.user_cache[1] = (cached_user, time.monotonic() - 1)
+
+    assert client.get("/").status_code == 200
+    user, expires = site.user_cache[1]
+    assert user is not cached_user
+    assert expires > time.monotonic()
+
+def test_logout_clears_caches(client):
+    client.get("/")
+    assert 1 in site.user_cache and 1 in site.history_cache
+
+    client.get("/logout")
+    assert 1 not in site.user_cache
+    assert 1 not in site.history_cache
@@ -0,0 +1,35 @@
+import os
+from unittest import mock
+
+import pytest
+
+os.environ.setdefault("CATALOG_ID", "test_catalog")
+os.environ.setdefault("OAUTH_TOKEN", "test_token")
+
+import logo_generator
+from logo_generator import OperationFailed, generate_logo
+
+@pytest.fixture(autouse=True)
+def no_network():
+    with mock.patch.object(logo_generator, "get_iam_token", return_value="iam"), \
+            mock.patch.object(logo_generator.time, "sleep"):
+        yield
+
+def test_polling_timeout_does_not_resubmit():
+    submitted = []
+    with mock.patch.object(logo_generator, "submit_generation", return_value="op1") as submit, \
+            mock.patch.object(logo_generator, "fetch_generation",
+                              side_effect=[Exception("polling timeout"), b"img"]) as fetch:
+        assert generate_logo("кот", on_submit=submitted.append) == b"img"
+
+    assert submit.call_count == 1
+    assert submitted == ["op1"]
+    assert [call.args[0] for call in fetch.call_args_list] == ["op1", "op1"]
+
+def test_failed_operation_is_resubmitted():
+    with mock.patch.object(logo_generator, "submit_generation", side_effect=["op1", "op2"]) as submit, \
+            mock.patch.object(logo_generator, "fetch_generation",
+                              side_effect=[OperationFailed("error"), b"img"]):
+        assert generate_logo("кот") == b"img"
+
+    assert submit.call_count == 2
@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Flask
+
+from models import db, ImageHistory, PendingOperation
+from operation_journal import journaled, drop_operation, is_expired, pending_operations, pending_max_age_hours
+
+@pytest.fixture
+def app_context():
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:"
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield
+        db.session.remove()
+
+def test_on_submit_records_operation(app_context):
+    operation_ids, on_submit = journaled("кот", "site", user_id=1)
+    on_submit("op1")
+    assert operation_ids == ["op1"]
+    assert db.session.get(PendingOperation, "op1").user_id == 1
+
+def test_failed_journal_commit_keeps_session_usable(app_context):
+    operation_ids, on_submit = journaled("кот", "bot", tg_user_id=42)
+    on_submit("op1")
+    # Повторный ID — commit журнала падает с IntegrityError
+    with pytest.raises(Exception):
+        on_submit("op1")
+
+    # Картинка всё равно сохраняется в той же сессии
+    db.session.add(ImageHistory(prompt="кот", filename="f.jpg", tg_user_id=42, source="bot"))
+    db.session.commit()
+
+    assert ImageHistory.query.count() == 1
+
+def test_drop_operation_and_expiry(app_context):
+    old = PendingOperation(id="old", prompt="кот", source="bot", tg_user_id=42,
+                           created_at=datetime.utcnow() - timedelta(hours=pending_max_age_hours + 1))
+    fresh = PendingOperation(id="fresh", prompt="кот", source="bot", tg_user_id=42)
+    db.session.add_all([old, fresh])
+    db.session.commit()
+
+    assert is_expired(old)
+    assert not is_expired(fresh)
+
+    drop_operation("old")
+    assert [operation.id for operation in pending_operations("bot")] == ["fresh"]